@@ -1,6 +1,16 @@
+import os
+import collections
+import queue
+import random
+import re
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeout
 import streamlit as st
+import pandas as pd
 import gspread
 from google.oauth2.service_account import Credentials
+from gspread.exceptions import APIError
 
 SCOPES = [
     "https://www.googleapis.com/auth/spreadsheets",
@@ -21,4 +31,185 @@ def get_workbook(name: str):
 @st.cache_resource
 def get_sheet(spreadsheet_name: str, title: str):
     wb = get_workbook(spreadsheet_name)
-    return wb.worksheet(title)
\ No newline at end of file
+    return wb.worksheet(title)
+
+@st.cache_resource
+def sheet_key(spreadsheet_name: str, title: str) -> str:
+    """캐시 키용 '스프레드시트ID:워크시트ID'. 한 번만 계산 (.id가 없는 gspread 버전은 제목으로 폴백)."""
+    ws = get_sheet(spreadsheet_name, title)
+    return f"{ws.spreadsheet.id}:{getattr(ws, 'id', ws.title)}"
+
+# ------------------ 범위별 전체 조회 ------------------
+# 출석기록 / 출석코드 / 페널티기록을 범위마다 따로 캐싱 → 필요한 범위만 읽고,
+# 쓰기 후에도 바뀐 범위 하나만 fetch_range.clear(이름, 범위)로 비움. 두 페이지가 같은 키를 공유.
+ATT_RANGE = "'출석기록'!A:G"
+CODE_RANGE = "'출석코드'!A1:B1"
+PEN_RANGE = "'페널티기록'!A:E"
+
+@st.cache_data(ttl=60)
+def fetch_range(spreadsheet_name: str, rng: str) -> list[list[str]]:
+    """범위 하나의 값(2차원 리스트)을 values.get 한 번으로 반환. 빈 범위는 []."""
+    return get_workbook(spreadsheet_name).values_get(rng).get("values", [])
+
+# ------------------ 일시 오류 재시도 ------------------
+RETRY_HINTS = ("rate limit", "quota", "backenderror", "internal error", "timeout", "429", "503", "500")
+# 일시 오류 신호를 정규식 하나로 미리 컴파일 → 메시지를 한 번만 훑음
+RETRY_RE = re.compile(
+    "|".join(map(re.escape, RETRY_HINTS + ("deadline", "socket", "ratelimitexceeded", "quotaexceeded"))),
+    re.IGNORECASE,
+)
+
+def should_retry(exc: APIError) -> bool:
+    """흔한 일시 오류(429/5xx/쿼터/타임아웃 등)인지 메시지로 판별."""
+    return bool(RETRY_RE.search(str(exc)))
+
+def do_with_retry(fn, max_retries: int = 12):
+    """
+    fn(attempt)을 실행하고 일시 오류에 지수 백오프 + 지터로 재시도 (attempt는 1부터).
+    - APIError: 일시 오류(429/5xx/쿼터 등)만 재시도(최대 20초 간격), 그 외·마지막 시도는 상향
+    - 네트워크 등 그 밖의 예외: 재시도(최대 12초 간격), 끝까지 실패하면 False
+    """
+    delay = 0.6
+    for attempt in range(1, max_retries + 1):
+        try:
+            return fn(attempt)
+        except APIError as e:
+            if not should_retry(e) or attempt == max_retries:
+                raise  # 비일시 오류 → 즉시 상향
+            cap = 20.0
+        except Exception:
+            if attempt == max_retries:
+                return False
+            cap = 12.0
+        time.sleep(delay + random.random() * 0.5)  # 지터
+        delay = min(delay * 1.8, cap)
+    return False
+
+# ------------------ 워크시트별 쓰기 락 ------------------
+@st.cache_resource
+def get_locks():
+    # 프로세스 전역 공유: 같은 워크시트 쓰기끼리만 직렬화, 서로 다른 시트는 병렬
+    return collections.defaultdict(threading.Lock)
+
+def ws_lock(ws) -> threading.Lock:
+    """워크시트 핸들(get_sheet로 캐싱되어 id 고정)별 쓰기 락. 읽기 경로는 락 없이."""
+    return get_locks()[id(ws)]
+
+# ------------------ 부원명단 (CSV → Parquet) ------------------
+def ensure_members_parquet(csv_path: str) -> str | None:
+    """
+    CSV 옆에 같은 이름의 .parquet를 만들어 둠(없거나 CSV가 더 새로우면 재생성).
+    pyarrow가 없거나 변환 실패 시 None → 호출 측에서 CSV로 폴백.
+    """
+    pq_path = os.path.splitext(csv_path)[0] + ".parquet"
+    try:
+        if os.path.exists(pq_path) and os.path.getmtime(pq_path) >= os.path.getmtime(csv_path):
+            return pq_path
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        df = pd.read_csv(csv_path, encoding="utf-8-sig", dtype={"고유번호": str})  # 앞자리 0 유지
+        df = df.loc[:, ~df.columns.str.startswith("Unnamed")]                     # 빈 꼬리 컬럼 제거
+        pq.write_table(pa.Table.from_pandas(df, preserve_index=False), pq_path, compression="zstd")
+        return pq_path
+    except Exception:
+        return None
+
+def read_members(csv_path: str, columns: list[str] | None = None) -> pd.DataFrame:
+    """부원명단 로드: Parquet(pyarrow 백엔드) 우선, 실패 시 기존 CSV 경로로 폴백."""
+    pq_path = ensure_members_parquet(csv_path)
+    if pq_path:
+        try:
+            return pd.read_parquet(pq_path, columns=columns, dtype_backend="pyarrow")
+        except Exception:
+            pass
+    # CSV 폴백은 C 엔진으로: pyarrow 엔진은 타입을 먼저 추론한 뒤 dtype을 적용해서
+    # "0823" 같은 고유번호가 823으로 바뀜 → 문자열 dtype이 파싱 단계에서 바로 적용되는 C 엔진만 사용
+    if columns is not None:
+        # 필요한 컬럼만 문자열로 고정해 읽음(타입 추론 생략). 컬럼이 없으면 ValueError로 바로 드러남
+        return pd.read_csv(csv_path, encoding="utf-8-sig", usecols=columns,
+                           dtype={c: "string" for c in columns}, engine="c")
+    return pd.read_csv(csv_path, encoding="utf-8-sig", dtype={"고유번호": str}, engine="c")
+
+# ------------------ 시트 값 → DataFrame ------------------
+def rows_to_frame(rows: list[list], header: list[str]) -> pd.DataFrame:
+    """시트 값(2차원 리스트) → DataFrame. 뒤쪽 빈 셀이 잘린 행은 헤더 길이에 맞춰 채움."""
+    width = len(header)
+    body = [list(r[:width]) + [""] * (width - len(r)) for r in rows]
+    return pd.DataFrame(body, columns=header)
+
+def categorize(df: pd.DataFrame, cols) -> pd.DataFrame:
+    """중복이 많은 문자열 컬럼은 category(정수 코드)로 → 메모리↓, ==/isin/groupby 비교 빠름."""
+    for col in cols:
+        if col in df.columns:
+            df[col] = df[col].astype("category")
+    return df
+
+# ------------------ 배치 쓰기 (단일 writer 스레드) ------------------
+class SheetWriter:
+    """
+    워크시트 1개 전용 백그라운드 쓰기 스레드.
+    - put(row): 큐에 넣고 즉시 Future 반환 (UI는 기다리지 않아도 됨)
+    - 스레드가 interval 동안 모인 행(최대 max_batch)을 flush(rows) 1회로 기록 → HTTP 1번
+    """
+    def __init__(self, flush, interval: float = 0.5, max_batch: int = 50):
+        self._flush = flush
+        self._q: queue.Queue = queue.Queue()
+        self.interval = interval
+        self.max_batch = max_batch
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def put(self, row: list) -> Future:
+        fut: Future = Future()
+        self._q.put((row, fut))
+        return fut
+
+    def _drain(self) -> list:
+        batch = [self._q.get()]  # 첫 행이 들어올 때까지 대기
+        deadline = time.monotonic() + self.interval
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._q.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._drain()
+            try:
+                ok = self._flush([row for row, _ in batch])
+            except Exception as e:
+                for _, fut in batch:
+                    fut.set_exception(e)
+                continue
+            for _, fut in batch:
+                fut.set_result(ok)
+
+# 제출 후 화면에서 기록 완료를 기다리는 최대 시간(초). 넘기면 '접수됨'으로 안내하고 다음 재실행에 확인
+SUBMIT_WAIT_SEC = 8.0
+
+def wait_written(fut: Future, timeout: float = SUBMIT_WAIT_SEC) -> bool | None:
+    """writer Future를 timeout초까지 기다림. True: 기록 완료 / False: 실패 / None: 아직 기록 중."""
+    try:
+        return bool(fut.result(timeout=timeout))
+    except FutureTimeout:
+        return None
+    except Exception:
+        return False
+
+def settle_pending(key: str, on_fail) -> list:
+    """
+    session_state[key]의 (Future, 행) 중 아직 기록 중인 것만 남김.
+    실패한 건은 on_fail(행)으로 처리(알림 등). 남은 (Future, 행) 목록을 반환.
+    """
+    still = []
+    for fut, row in st.session_state.get(key, []):
+        if not fut.done():
+            still.append((fut, row))
+        elif fut.exception() is not None or not fut.result():
+            on_fail(row)
+    st.session_state[key] = still
+    return still
@@ -1,15 +1,13 @@
 import streamlit as st
-import gspread
 from datetime import datetime
 import zoneinfo  # ✅ 추가
 KST = zoneinfo.ZoneInfo("Asia/Seoul")  # ✅ 추가
-from google.oauth2.service_account import Credentials
-import threading
 import time
-from gspread.exceptions import APIError
 import pandas as pd
 import os
-from common_io import get_workbook, get_sheet
+from common_io import (get_workbook, get_sheet, read_members, SheetWriter, ws_lock, fetch_range, PEN_RANGE,
+                       do_with_retry, wait_written,
+                       rows_to_frame, categorize, settle_pending)
 
 st.page_link("출석.py", label="⬅️ 돌아가기")
 
@@ -48,95 +46,137 @@ def load_members_csv(path: str, mtime: float) -> pd.DataFrame:
     if not os.path.exists(path):
         return pd.DataFrame(columns=["이름", "고유번호"])
     try:
-        df = pd.read_csv(path, encoding="utf-8-sig", dtype={"고유번호":str})
+        df = read_members(path, columns=["이름", "고유번호"])
     except UnicodeDecodeError:
-        df = pd.read_csv(path)
-    for col in ["이름", "고유번호"]:
-        if col not in df.columns:
-            df[col] = ""
-    df["이름"] = df["이름"].astype(str).str.strip()
-    df["고유번호"] = df["고유번호"].astype(str).str.strip()
+        df = pd.read_csv(path, usecols=["이름", "고유번호"], dtype="string")
+    df["이름"] = df["이름"].fillna("").astype(str).str.strip()
+    df["고유번호"] = df["고유번호"].fillna("").astype(str).str.strip()
     return df[["이름", "고유번호"]]
 
-members_mtime = os.path.getmtime(MEMBERS_CSV) if os.path.exists(MEMBERS_CSV) else 0.0
+@st.cache_resource
+def get_name_options(path: str, mtime: float) -> tuple[str, ...]:
+    """정렬된 이름 목록(불변 tuple). load_members_csv와 같은 (path, mtime) 키로 1회만 계산."""
+    arr = load_members_csv(path, mtime)["이름"].to_numpy()
+    return tuple(sorted({n for n in arr.tolist() if n}))
+
+@st.cache_resource(ttl=5)
+def members_stat() -> float:
+    """부원명단 mtime (stat 1회, 5초 캐싱). 파일이 없으면 0.0."""
+    try:
+        return os.stat(MEMBERS_CSV).st_mtime
+    except FileNotFoundError:
+        return 0.0
+
+members_mtime = members_stat()
 members_df = load_members_csv(MEMBERS_CSV, members_mtime)
-name_options = sorted([n for n in members_df["이름"].dropna().astype(str).unique() if n])
+name_options = get_name_options(MEMBERS_CSV, members_mtime)
 
 
 if members_df.empty or not name_options:
     st.warning(f"'{MEMBERS_CSV}'에서 이름 목록을 불러오지 못했습니다. 파일과 컬럼(이름, 고유번호)을 확인하세요.")
 
 # ================== 동시성 안전 append ==================
+def safe_append_rows(ws, rows, max_retries=12):
+    """ append_rows(여러 행 1회 요청)를 워크시트별 락 + 지수 백오프(+지터)로 안정 처리 """
+    def op(_attempt):
+        with ws_lock(ws):
+            ws.append_rows(rows, value_input_option="RAW")
+        return True
+    return do_with_retry(op, max_retries)
+
 @st.cache_resource
-def get_sheet_lock():
-    return threading.Lock()
-sheet_lock = get_sheet_lock()
-
-_RETRY_HINTS = ("rate limit", "quota", "backenderror", "internal error", "timeout", "429", "503", "500")
-
-def safe_append_row(ws, row_values, max_retries=12):
-    """ append_row를 전역 락 + 지수 백오프(+지터)로 안정 처리 """
-    delay = 0.6
-    for attempt in range(1, max_retries + 1):
-        try:
-            with sheet_lock:
-                ws.append_row(row_values, value_input_option="RAW")
-            return True
-
-        except APIError as e:
-            msg = str(e).lower()
-            transient = any(h in msg for h in _RETRY_HINTS) or \
-                        "deadline" in msg or "socket" in msg or \
-                        "ratelimitexceeded" in msg or "quotaexceeded" in msg
-            if transient and attempt < max_retries:
-                time.sleep(delay + __import__("random").random() * 0.5)  # 지터
-                delay = min(delay * 1.8, 20.0)
-                continue
-            raise  # 비일시 오류는 상향
-
-        except (TimeoutError,):
-            if attempt < max_retries:
-                time.sleep(delay + __import__("random").random() * 0.5)
-                delay = min(delay * 1.8, 12.0)
-                continue
-            return False
-
-        except Exception:
-            if attempt < max_retries:
-                time.sleep(delay + __import__("random").random() * 0.5)
-                delay = min(delay * 1.8, 12.0)
-                continue
-            return False
-    return False
+def get_penalty_writer() -> SheetWriter:
+    # 프로세스 전역 단일 writer: 여러 세션의 제출을 모아 append_rows 1회로 기록
+    return SheetWriter(lambda rows: safe_append_rows(sheet_penalty, rows))
 
 # ================== 공용 유틸 ==================
-@st.cache_data(ttl=60)
-def load_penalties_df(_sheet=sheet_penalty) -> pd.DataFrame:
-    rows = _sheet.get_all_records()
-    df = pd.DataFrame(rows)
-    if df.empty:
-        df = pd.DataFrame(columns=["시간", "이름", "사유", "점수", "누적 점수"])
-    if "점수" in df.columns:
-        df["점수"] = pd.to_numeric(df["점수"], errors="coerce").fillna(0).astype(int)
-    if "누적 점수" in df.columns:
-        df["누적 점수"] = pd.to_numeric(df["누적 점수"], errors="coerce").fillna(0).astype(int)
+PEN_COLUMNS = ["시간", "이름", "사유", "점수", "누적 점수"]
+
+def _penalty_rows_to_df(rows: list[list], header: list[str]) -> pd.DataFrame:
+    """시트 값(2차원 리스트) → DataFrame (점수는 int, 이름·사유는 category)."""
+    df = rows_to_frame(rows, header)
+    for col in ("점수", "누적 점수"):
+        if col in df.columns:
+            df[col] = pd.to_numeric(df[col], errors="coerce").fillna(0).astype("int32")
+    return _categorize(df)
+
+PEN_CATEGORY_COLS = ("이름", "사유")
+
+def _categorize(df: pd.DataFrame) -> pd.DataFrame:
+    return categorize(df, PEN_CATEGORY_COLS)
+
+def _settle_pending() -> list[list]:
+    """writer에 넘긴 행 중 아직 기록 중인 것만 남김. 실패한 행은 화면에 알림."""
+    still = settle_pending(
+        "pending", lambda row: st.error(f"페널티 기록 저장 실패: {row[1]} / {row[2]} ({row[0]})")
+    )
+    return [row for _, row in still]
+
+def load_penalties_df(_sheet=sheet_penalty, fresh: bool = False) -> pd.DataFrame:
+    """
+    시트 기록 + 아직 기록 중인(pending) 행을 합친 DataFrame.
+    제출 직후에도 낙관적으로 반영되어 누적 점수가 밀리지 않음. fresh=True면 꼬리 조회 간격을 무시.
+    """
+    pending = _settle_pending()
+    df = _fetch_penalties(_sheet, fresh=fresh)
+    if pending:
+        df = pd.concat([df, _penalty_rows_to_df(pending, list(df.columns))], ignore_index=True)
+        # 방금 시트에 반영된 행과 겹치면 한 번만 남김
+        df = _categorize(df.drop_duplicates(subset=["시간", "이름", "사유"], keep="first"))
     return df
 
+PEN_TAIL_TTL = 15  # 꼬리 조회 최소 간격(초): 재실행마다 시트를 두드리지 않도록
+
+def _fetch_penalties(_sheet, fresh: bool = False) -> pd.DataFrame:
+    """
+    페널티기록을 세션에 캐싱하고, 이후 호출에서는 새로 추가된 꼬리 행만 가져옴.
+    - 최초 1회: 페널티기록 범위 캐시(fetch_range, 세션 간 공유)로 전체 로드 + 마지막 행 번호 기록
+    - 이후: PEN_TAIL_TTL초마다(fresh=True면 즉시) A{last+1}:E 범위만 읽어 concat (O(전체) → O(추가분))
+    - 꼬리 조회가 실패하면 알림만 하고 캐시된 표를 그대로 사용
+    """
+    ss = st.session_state
+    cached = ss.get("_pen_df")
+    if cached is None:
+        vals = fetch_range(SPREADSHEET_NAME, PEN_RANGE)
+        header = vals[0] if vals else PEN_COLUMNS
+        ss["_pen_df"] = _penalty_rows_to_df(vals[1:], header)
+        ss["_pen_last_row"] = max(len(vals), 1)  # 빈 시트여도 1행(헤더)은 건너뜀
+        ss["_pen_checked"] = time.time()
+        return ss["_pen_df"]
+
+    if not fresh and time.time() - ss.get("_pen_checked", 0.0) < PEN_TAIL_TTL:
+        return cached
+
+    last = ss["_pen_last_row"]
+    try:
+        tail = _sheet.get(f"A{last + 1}:E")
+    except Exception as e:
+        st.toast(f"페널티 기록 새로고침 실패(이전 데이터 표시): {e}", icon="⚠️")
+        return cached
+    ss["_pen_checked"] = time.time()
+    if tail:
+        new_df = _penalty_rows_to_df(tail, list(cached.columns))
+        # 카테고리 집합이 달라 concat 후 object로 풀리므로 다시 category로
+        ss["_pen_df"] = _categorize(pd.concat([cached, new_df], ignore_index=True))
+        ss["_pen_last_row"] = last + len(tail)
+    return ss["_pen_df"]
 
-def calc_total_for_name(name: str, base_df: pd.DataFrame | None = None) -> int:
-    df = base_df if base_df is not None else load_penalties_df()
-    if "이름" not in df.columns:
-        return 0
-    return int(df.loc[df["이름"] == name, "점수"].sum())
+@st.cache_resource
+def members_index(path: str, mtime: float) -> dict[str, str]:
+    """이름 → 고유번호 사전(동명이인은 CSV 첫 행 우선). 로그인 검증을 O(1) 조회로."""
+    df = load_members_csv(path, mtime)
+    code_map: dict[str, str] = {}
+    for n, c in zip(df["이름"], df["고유번호"]):
+        code_map.setdefault(n, c)
+    return code_map
 
 def verify_member(name: str, code: str) -> bool:
     """부원명단.csv 기반 검증. 고유번호 컬럼이 비어있으면 이름만으로 통과."""
     if not name:
         return False
-    row = members_df[members_df["이름"] == str(name).strip()]
-    if row.empty:
+    expected_code = members_index(MEMBERS_CSV, members_mtime).get(str(name).strip())
+    if expected_code is None:
         return False
-    expected_code = str(row.iloc[0]["고유번호"]).strip()
     # 고유번호가 CSV에 없거나 빈 값이면 이름만으로 통과
     if not expected_code:
         return True
@@ -181,7 +221,11 @@ with tab_me:
 
                 if "사유" in my_df.columns and "점수" in my_df.columns:
                     st.write("### 사유별 합계")
-                    by_reason = my_df.groupby("사유", as_index=False)["점수"].sum()
+                    # 한 사람 기록은 수십 행 수준 → groupby 대신 한 번 훑어 합산
+                    agg: dict[str, int] = {}
+                    for r, p in zip(my_df["사유"].to_numpy(), my_df["점수"].to_numpy()):
+                        agg[r] = agg.get(r, 0) + int(p)
+                    by_reason = pd.DataFrame({"사유": list(agg), "점수": list(agg.values())})
                     st.dataframe(by_reason)
 
 # -------- 관리자 입력 (서브) --------
@@ -219,17 +263,24 @@ with tab_admin:
                 st.error("이름과 사유를 모두 입력하세요.")
             else:
                 now = datetime.now(KST).strftime("%Y-%m-%d %H:%M:%S")
-                df_now = load_penalties_df()
-                total_score = calc_total_for_name(name, df_now) + point_val
-                try:
-                    safe_append_row(
-                        sheet_penalty,
-                        [now, name, reason_val, point_val, int(total_score)]
-                    )
+                # 누적 점수는 제출 시점에 시트(+이 세션의 기록 중인 행)에서 다시 합산
+                # → 수동 수정·삭제나 다른 프로세스 기록도 그대로 반영됨
+                df_pen = load_penalties_df(fresh=True)
+                prev = int(df_pen.loc[df_pen["이름"] == name, "점수"].sum()) if "점수" in df_pen.columns else 0
+                total_score = prev + point_val
+                row = [now, name, reason_val, point_val, int(total_score)]
+                # 실제 기록은 writer 스레드가 묶어서 처리 → 완료 여부는 잠시만 기다려 확인
+                fut = get_penalty_writer().put(row)
+                ok = wait_written(fut)
+                if ok:
                     st.success(f"✅ {name}님 페널티 기록 완료! (이번 {point_val}, 누적 {int(total_score)})")
-                    st.cache_data.clear()   # ✅ 새 데이터 반영을 위해 데이터 캐시 비우기
-                except Exception as e:
-                    st.error(f"기록 중 오류가 발생했어요: {e}")
+                elif ok is None:
+                    # 아직 기록 중 → 다음 재실행 때 _settle_pending()이 결과 확인
+                    st.session_state.setdefault("pending", []).append((fut, row))
+                    st.info(f"⏳ {name}님 페널티 접수됨 (기록 중, 이번 {point_val}, 누적 {int(total_score)})")
+                else:
+                    st.error(f"페널티 기록 저장 실패: {name} / {reason_val} — 다시 제출해 주세요.")
+                fetch_range.clear(SPREADSHEET_NAME, PEN_RANGE)   # ✅ 새 세션의 첫 로드가 새 데이터를 받도록 페널티 범위만 비우기
 
     else:
         st.info("관리자 비밀번호를 입력하면 기록 폼이 열립니다.")
@@ -1,17 +1,18 @@
 import streamlit as st
 import pandas as pd
 from datetime import datetime
-import gspread
-from google.oauth2.service_account import Credentials
 import time
 import threading
 import uuid
 import zoneinfo   # ✅ 추가
-from gspread.exceptions import APIError
+from gspread.utils import rowcol_to_a1
 import random
-from requests.exceptions import RequestException, Timeout, ConnectionError
+import re
 import hashlib  # ✅ 추가
-from common_io import get_sheet
+import hmac
+from common_io import (get_sheet, sheet_key, read_members, ws_lock, fetch_range, ATT_RANGE, CODE_RANGE,
+                       SheetWriter, do_with_retry, wait_written,
+                       rows_to_frame, categorize, settle_pending)
 
 # ✅ 한국 시간대 설정 (전역에서 재사용)
 KST = zoneinfo.ZoneInfo("Asia/Seoul")
@@ -42,55 +43,16 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
-@st.cache_resource
-def get_sheet_lock():
-    # 서버 프로세스 전역에서 하나만 생성되어 모든 세션이 공유
-    return threading.Lock()
-
-sheet_lock = get_sheet_lock()
-
-_RETRY_HINTS = ("rate limit", "quota", "backendError", "internal error", "timeout", "429", "503", "500")
-
-def safe_append_row(ws, row_values, max_retries=12):
+def save_code_cell(ws, digest: str, saved_at: str) -> bool:
     """
-    Google Sheets append_row 안전 호출(고동시성 대응):
-    - 전역 락으로 동시 호출 직렬화
-    - 429/5xx/네트워크 예외에 지수 백오프 + 지터
+    출석코드 A1:B1을 values.update 한 번으로 덮어씀 (clear + append 두 번 호출 대신).
+    해시가 숫자/지수 표기로 해석되지 않도록 RAW로 기록. 일시 오류는 재시도.
     """
-    delay = 0.6
-    for attempt in range(1, max_retries + 1):
-        try:
-            with sheet_lock:
-                ws.append_row(row_values, value_input_option="USER_ENTERED")
-            return True
-
-        except APIError as e:
-            msg = str(e).lower()
-            # 흔한 일시 오류 신호들
-            transient = any(h in msg for h in _RETRY_HINTS) or \
-                        "deadline" in msg or "socket" in msg or \
-                        "ratelimitexceeded" in msg or "quotaexceeded" in msg
-            if transient and attempt < max_retries:
-                time.sleep(delay + random.random() * 0.5)  # 지터
-                delay = min(delay * 1.8, 20.0)
-                continue
-            raise  # 비일시 오류 → 즉시 상향
-
-        except (Timeout, ConnectionError, RequestException):
-            if attempt < max_retries:
-                time.sleep(delay + random.random() * 0.5)
-                delay = min(delay * 1.8, 12.0)
-                continue
-            return False
-
-        except Exception:
-            if attempt < max_retries:
-                time.sleep(delay + random.random() * 0.5)
-                delay = min(delay * 1.8, 12.0)
-                continue
-            return False
-
-    return False
+    def op(_attempt):
+        with ws_lock(ws):
+            ws.update(range_name="A1:B1", values=[[digest, saved_at]], value_input_option="RAW")
+        return True
+    return do_with_retry(op)
 
 def daily_token(name: str, date_str: str) -> str:
     """
@@ -98,130 +60,126 @@ def daily_token(name: str, date_str: str) -> str:
     (하루 1명 1건 정책 / 여러 번 허용하려면 date_str 뒤에 |status|time_slot 등 포함)
     """
     base = f"{name.strip()}|{date_str}"
-    return hashlib.sha1(base.encode("utf-8")).hexdigest()[:8]
-
-def _read_tokens_fresh(ws) -> set[str]:
-    """락 구간에서 캐시된 '토큰' 열 인덱스 활용(빠름), 실패 시 폴백."""
-    try:
-        col_idx = _get_token_col_index(ws, SHEET_KEY)
-        if col_idx:
-            vals = ws.col_values(col_idx)[1:]  # 헤더 제외
-            return {str(v).strip() for v in vals if v}
-        # 폴백: 전체 레코드에서 '토큰' 키만 추출
-        records = ws.get_all_records()
-        return {str(r.get("토큰", "")).strip() for r in records if r.get("토큰")}
-    except Exception:
-        return set()
+    return hashlib.blake2b(base.encode("utf-8"), digest_size=4).hexdigest()  # 8자리 hex, 보안 용도 아님
 
-def append_once(ws, values, max_retries=12):
+def _token_set(col) -> set[str]:
     """
-    확인+쓰기까지 '한 번의 락'으로 묶어 중복을 원천 차단.
-    이미 같은 토큰이 있으면 쓰지 않고 True 반환(성공 취급).
+    한 열짜리 values.get 결과([[v], [], ...]) → 토큰 set.
+    공백 제거·빈 값 걸러내기는 pandas 문자열 벡터 연산 한 번으로 (토큰마다 Python strip 호출 없음).
     """
-    delay = 0.6
-    for attempt in range(1, max_retries + 1):
-        try:
-            with sheet_lock:
-                token = str(values[-1]).strip()
-                tokens = _read_tokens_fresh(ws)
-                if token in tokens:
-                    return True  # 누가 먼저 썼음 → 중복 방지 OK
-
-                ws.append_row(values, value_input_option="USER_ENTERED")
-                st.cache_data.clear()  # ✅ 성공 직후 캐시 무효화
-                return True
-
-        except APIError as e:
-            msg = str(e).lower()
-            transient = any(h in msg for h in _RETRY_HINTS) or \
-                        "deadline" in msg or "socket" in msg or \
-                        "ratelimitexceeded" in msg or "quotaexceeded" in msg
-            if transient and attempt < max_retries:
-                time.sleep(delay + random.random() * 0.5)
-                delay = min(delay * 1.8, 20.0)
-                continue
-            raise
-        except (Timeout, ConnectionError, RequestException):
-            if attempt < max_retries:
-                time.sleep(delay + random.random() * 0.5)
-                delay = min(delay * 1.8, 12.0)
-                continue
-            return False
-        except Exception:
-            if attempt < max_retries:
-                time.sleep(delay + random.random() * 0.5)
-                delay = min(delay * 1.8, 12.0)
-                continue
-            return False
-    return False
-
-@st.cache_data(ttl=600)
-def _get_token_col_index(_ws, sheet_key: str) -> int | None:
-    """'토큰' 헤더가 있는 열 인덱스를 캐싱(1-base). 못 찾으면 None."""
-    try:
-        cell = _ws.find("토큰")  # 헤더 탐색(비용 큼) → 10분 캐싱
-        return cell.col if cell else None
-    except Exception:
-        return None
+    vals = pd.Series([r[0] if r else "" for r in col], dtype="string").str.strip()
+    return set(vals[vals != ""].tolist())
 
-@st.cache_data(ttl=30)
-def existing_tokens(_ws, sheet_key: str) -> set[str]:
+def _token_values(ws) -> set[str]:
     """
-    토큰 열만 읽어서 Set으로 반환(부하 최소화).
-    - 토큰 열을 못 찾으면 기존 전체 레코드 fallback.
+    출석기록의 토큰 집합 (주기적 재동기화·재시도 경로가 같은 열 찾기 규칙을 쓰도록 한 곳에서만 읽음).
+    헤더 행과 기본 토큰 열(G)을 batch_get 한 번으로 받아, 헤더가 맞으면 그대로 사용(HTTP 1회).
+    열이 옮겨졌으면 헤더에서 '토큰' 위치를 찾아 그 열만 다시 조회.
+    UNFORMATTED 값으로 읽어 숫자처럼 보이는 토큰도 항상 같은 문자열이 됨.
     """
-    try:
-        col_idx = _get_token_col_index(_ws, sheet_key)
-        if col_idx:
-            # 헤더(1행) 제외
-            vals = _ws.col_values(col_idx)[1:]
-            return {str(v).strip() for v in vals if v}
-        # fallback: 전체 레코드
-        records = _ws.get_all_records()
-        return {str(r.get("토큰", "")).strip() for r in records if r.get("토큰")}
-    except Exception:
+    header_rng, col = ws.batch_get(
+        ["1:1", f"{TOKEN_COL_A1}2:{TOKEN_COL_A1}"], value_render_option="UNFORMATTED_VALUE"
+    )
+    header = [str(h).strip() for h in (header_rng[0] if header_rng else [])]
+    if "토큰" not in header:
         return set()
+    letter = rowcol_to_a1(1, header.index("토큰") + 1)[:-1]
+    if letter != TOKEN_COL_A1:
+        col = ws.get(f"{letter}2:{letter}", value_render_option="UNFORMATTED_VALUE")
+    return _token_set(col)
 
-    
-SPREADSHEET_NAME = "출석"
-sheet = get_sheet(SPREADSHEET_NAME, "출석기록")
-code_sheet = get_sheet(SPREADSHEET_NAME, "출석코드")
+ROW_RECONCILE_SEC = 60  # 이 시간이 지나면 토큰 집합을 시트로 다시 맞춤 (수동 편집 대비)
 
-# 캐시 키(스프레드시트ID:워크시트ID) - gspread 버전에 따라 .id가 없으면 제목으로 폴백
-SHEET_KEY = f"{sheet.spreadsheet.id}:{getattr(sheet, 'id', sheet.title)}"
+@st.cache_resource
+def token_cache() -> dict:
+    """이 프로세스가 아는 출석기록 토큰 집합. 쓰기 락 안에서만 읽고 갱신(기록 성공 시 추가)."""
+    return {"set": None, "checked": 0.0}
 
+def _last_written_row(resp) -> int | None:
+    """append_rows 응답의 updatedRange(예: '출석기록'!A12:G13)에서 끝 행 번호. 없으면 None."""
+    updated = ((resp or {}).get("updates") or {}).get("updatedRange", "")
+    m = re.search(r"(\d+)$", updated)
+    return int(m.group(1)) if m else None
 
+def append_once(ws, rows, max_retries=12):
+    """
+    확인+쓰기까지 '한 번의 락'으로 묶어 중복을 원천 차단 (여러 행을 한 번에 처리).
+    이미 시트에 있거나 같은 배치 안에서 겹치는 토큰은 건너뛰고,
+    남은 행만 append_rows 1회로 기록. 건너뛴 행도 성공 취급(True).
+    """
+    def op(attempt):
+        with ws_lock(ws):
+            # 평소: 프로세스 메모리의 토큰 집합으로 확인 → 쓰기 경로에서 시트 읽기 없음
+            # 처음·ROW_RECONCILE_SEC 경과·재시도: 캐시를 거치지 않고 시트에서 새로 읽음
+            # (수동 삭제된 행의 재제출이 중복으로 버려지지 않게, 실패한 요청이 반영됐는지도 확인)
+            # 읽기가 실패하면 예외가 그대로 올라가 기존 집합은 유지되고 do_with_retry가 다시 시도
+            tc = token_cache()
+            if attempt > 1 or tc["set"] is None or time.time() - tc["checked"] > ROW_RECONCILE_SEC:
+                tc["set"], tc["checked"] = _token_values(ws), time.time()
+            tokens = tc["set"]
+            fresh, batch_tokens = [], set()
+            for values in rows:
+                token = str(values[-1]).strip()
+                if token in tokens or token in batch_tokens:
+                    continue  # 누가 먼저 썼음 → 중복 방지 OK
+                batch_tokens.add(token)
+                fresh.append(values)
+
+            if fresh:
+                resp = ws.append_rows(fresh, value_input_option="USER_ENTERED",
+                                      insert_data_option="INSERT_ROWS")
+                tokens |= batch_tokens  # 기록이 끝난 토큰만 추가 (실패 시 재제출이 막히지 않게)
+                # ✅ 바뀐 출석기록 관련 캐시만 무효화 (출석코드·페널티·부원명단 등은 유지)
+                fetch_range.clear(SPREADSHEET_NAME, ATT_RANGE)
+                invalidate_attendance_df(_last_written_row(resp))
+            return True
+    return do_with_retry(op, max_retries)
 
-# 오늘 날짜 데이터만 분리하고 상태별로 나누는 함수
-def split_today_status(df):
-    today = datetime.today().strftime("%Y-%m-%d")
-    today_att = df[df["날짜"] == today].copy()
+# 기록 행 [이름, 시간, 상태, 시간대, 같이한 부원, 사유, 토큰] → 토큰은 7번째(G) 열
+TOKEN_COL_A1 = "G"
 
-    if "출석여부" not in today_att.columns:
-        raise KeyError("⚠️ DataFrame에 '출석여부' 컬럼이 없습니다.")
 
-    if "이름" not in today_att.columns:
-        raise KeyError("⚠️ DataFrame에 '이름' 컬럼이 없습니다.")
+SPREADSHEET_NAME = "출석"
+sheet = get_sheet(SPREADSHEET_NAME, "출석기록")
+code_sheet = get_sheet(SPREADSHEET_NAME, "출석코드")
 
-    df_attended = today_att[today_att["출석여부"] == "출석"].copy()
-    df_absented = today_att[today_att["출석여부"] == "결석"].copy()
-    df_unchecked = today_att[today_att["출석여부"].isna()].copy()
+# 캐시 키(스프레드시트ID:워크시트ID) - 프로세스당 한 번만 계산해 둔 값 사용
+SHEET_KEY = sheet_key(SPREADSHEET_NAME, "출석기록")
 
-    total_members = len(today_att["이름"].unique())
+@st.cache_resource
+def get_attendance_writer() -> SheetWriter:
+    # 프로세스 전역 단일 writer: 0.5초 안에 몰린 제출(최대 20건)을 시트 쓰기 1회로 기록
+    return SheetWriter(lambda rows: append_once(sheet, rows), interval=0.5, max_batch=20)
+
+def submit_attendance(values) -> bool | None:
+    """
+    출석/결석 1건을 배치 writer 큐에 넣고 기록이 끝날 때까지 잠시(SUBMIT_WAIT_SEC) 기다림.
+    True: 기록 완료 / False: 실패 / None: 아직 기록 중 → 다음 재실행 때 settle_pending_attendance()가 확인.
+    """
+    fut = get_attendance_writer().put(values)
+    attendance_cache()["last_submit"] = time.time()  # 제출이 이어지는 동안 대시보드 TTL을 짧게
+    ok = wait_written(fut)
+    if ok is None:
+        st.session_state.setdefault("pending_attendance", []).append((fut, values))
+    if ok is not False:
+        st.session_state.setdefault("local_attendance", []).append(values)
+    return ok
+
+def settle_pending_attendance() -> None:
+    """기록이 끝난 제출을 정리. 실패한 건은 알리고 화면 반영(local_attendance)에서도 뺌."""
+    def on_fail(values):
+        st.error(f"{values[0]}님 {values[2]} 기록 저장에 실패했습니다. 다시 제출해 주세요.")
+        local = st.session_state.get("local_attendance", [])
+        st.session_state.local_attendance = [r for r in local if r is not values]
+    settle_pending("pending_attendance", on_fail)
 
-    return df_attended, df_absented, df_unchecked, total_members
 
 # ------------------ CSV 불러오기 (고유번호 0 유지) ------------------
-@st.cache_data  # ✅ TTL 제거 → 완전 캐싱 (앱 새로 실행하기 전까지는 다시 안 불러옴)
+@st.cache_resource  # 완전 캐싱 + 복사 없이 공유 (읽기 전용 — 수정이 필요하면 호출 측에서 .copy())
 def load_members():
-    # "고유번호" 컬럼을 문자열(str)로 읽어 맨 앞 0 유지
-    return pd.read_csv("부원명단.csv", encoding="utf-8-sig", dtype={"고유번호": str})
-
-df = load_members()
-
-import re  # ← 상단 import 구역에 함께 추가
+    # Parquet(pyarrow) 우선, 없으면 CSV — 둘 다 "고유번호"는 문자열로 맨 앞 0 유지
+    return read_members("부원명단.csv")
 
-@st.cache_data
 def build_gcn_map(members_df: pd.DataFrame) -> dict[str, tuple[int,int,int]]:
     """
     CSV에서 이름 → (학년, 반, 번호) 매핑 생성
@@ -229,58 +187,89 @@ def build_gcn_map(members_df: pd.DataFrame) -> dict[str, tuple[int,int,int]]:
     - '학년반번호'(예: '1-3-12', '1학년 3반 12번') 형태도 파싱
     - 없거나 파싱 실패 시 해당 이름은 매핑 생략(정렬 후순위로 처리)
     """
-    m: dict[str, tuple[int,int,int]] = {}
-
-    # case 1) 분리 컬럼 존재
+    # case 1) 분리 컬럼 존재 → 숫자 변환을 컬럼 단위로 한 번에
     if {"학년", "반", "번호"}.issubset(members_df.columns):
-        for _, r in members_df.dropna(subset=["이름", "학년", "반", "번호"]).iterrows():
-            try:
-                name = str(r["이름"]).strip()
-                g = int(r["학년"])
-                c = int(r["반"])
-                n = int(r["번호"])
-                if name:
-                    # 동명이인 있을 경우 더 작은 (학,반,번)을 우선 보존
-                    m[name] = min(m.get(name, (999,999,999)), (g, c, n))
-            except Exception:
-                continue
-        return m
-
-    # case 2) 합쳐진 컬럼 찾기
-    merged_col = next(
-        (c for c in members_df.columns if c in ("학년반번호", "학년반", "학반번호")),
-        None
-    )
-    if merged_col:
-        for _, r in members_df.dropna(subset=["이름", merged_col]).iterrows():
-            name = str(r["이름"]).strip()
-            raw = str(r[merged_col])
-            nums = re.findall(r"\d+", raw)
-            if len(nums) >= 3:
-                try:
-                    g, c, n = int(nums[0]), int(nums[1]), int(nums[2])
-                    if name:
-                        m[name] = min(m.get(name, (999,999,999)), (g, c, n))
-                except Exception:
-                    continue
+        gcn = members_df[["학년", "반", "번호"]].apply(pd.to_numeric, errors="coerce")
+    else:
+        # case 2) 합쳐진 컬럼에서 앞의 숫자 3개를 정규식 한 번으로 추출
+        merged_col = next(
+            (c for c in members_df.columns if c in ("학년반번호", "학년반", "학반번호")),
+            None
+        )
+        if merged_col is None:
+            return {}
+        gcn = members_df[merged_col].astype(str).str.extract(r"(\d+)\D+(\d+)\D+(\d+)").apply(
+            pd.to_numeric, errors="coerce"
+        )
+    gcn.columns = ["_g", "_c", "_n"]
+    names = members_df["이름"]
+    gcn["이름"] = names.astype(str).str.strip()
+    gcn = gcn[names.notna() & gcn["이름"].ne("")].dropna(subset=["_g", "_c", "_n"])
 
-    return m
+    # 동명이인 있을 경우 더 작은 (학,반,번)을 우선 보존 → 정렬 후 이름별 첫 행
+    gcn = gcn.sort_values(["_g", "_c", "_n"], kind="stable").drop_duplicates(subset=["이름"])
+    g, c, n = (gcn[k].astype("int64").to_numpy() for k in ("_g", "_c", "_n"))
+    return dict(zip(gcn["이름"], zip(g.tolist(), c.tolist(), n.tolist())))
 
-GCN_MAP = build_gcn_map(df)
+@st.cache_resource
+def members_core() -> dict:
+    """
+    명단에서 파생된 조회용 객체를 프로세스당 한 번만 만들어 공유 (재실행마다 DataFrame 복사/해시 없음)
+    - pairs: (이름, 고유번호) frozenset → 제출 검증 O(1) 포함 검사 (동명이인도 각각 유효)
+    - names: 명단 순서 그대로의 이름 tuple(해시 가능) → 대시보드 분류 캐시 키/미체크 계산
+    - gcn / gcn_df: 이름 → (학년, 반, 번호) dict와 같은 내용의 이름 인덱스 DataFrame(정렬 키 벡터 조회)
+    """
+    members = load_members()
+    names = members["이름"].astype(str).str.strip()
+    gcn = build_gcn_map(members)
+    return {
+        "df": members,
+        "pairs": frozenset(zip(names, members["고유번호"].astype(str).str.strip())),
+        "names": tuple(names),
+        "gcn": gcn,
+        "gcn_df": pd.DataFrame.from_dict(gcn, orient="index", columns=["_g", "_c", "_n"]),
+    }
 
-def _gcn_tuple_for(name: str) -> tuple[int,int,int]:
-    """이름으로 (학년,반,번호) 조회. 없으면 정렬 후순위 키 반환"""
-    return GCN_MAP.get(str(name).strip(), (999, 999, 999))
+MEMBERS = members_core()
 
 
 # ------------------ 출석 코드 불러오기 ------------------
-@st.cache_data(ttl=60)  # 1분 캐싱
+CODE_STALE_SEC = 3600  # 코드는 관리자 저장 시 바로 교체되므로 시트 재조회는 이 주기의 안전망일 뿐
+
+@st.cache_resource
+def code_state() -> dict:
+    """프로세스 전역 최신 출석 코드. 첫 조회·관리자 저장 시 채워 모든 세션이 시트 조회 없이 사용."""
+    return {"value": None, "ts": 0.0}
+
+def code_digest(code: str) -> str:
+    """출석 코드의 sha256 해시. 시트·캐시에는 평문 대신 이 값만 저장/비교."""
+    return hashlib.sha256(str(code).strip().encode("utf-8")).hexdigest()
+
 def get_latest_code():
-    try:
-        value = code_sheet.acell("A1").value or ""
-        return str(value)  # 앞자리 0 유지
-    except:
-        return ""
+    """저장된 출석 코드 해시(64자 hex). 없거나 조회 실패 시 ""."""
+    state = code_state()
+    if state["value"] is not None and time.time() - state["ts"] < CODE_STALE_SEC:
+        return state["value"]
+    # 지터 백오프로 최대 4회 시도. 실패는 캐시에 남지 않으므로 다음 rerun에서 다시 조회됨
+    for attempt in range(4):
+        try:
+            code = _read_code_cell()[0]
+            if code:
+                state["value"], state["ts"] = code, time.time()
+            return code
+        except Exception as e:
+            if attempt == 3:
+                st.toast(f"출석 코드 조회 실패: {e}", icon="⚠️")
+                return ""
+            time.sleep(0.5 * (2 ** attempt) + random.random() * 0.2)
+
+def _read_code_cell() -> tuple[str, str]:
+    """출석코드 A1:B1 → (코드 해시, 저장 시각). 이 범위만 읽음 (60초 캐시)."""
+    vals = fetch_range(SPREADSHEET_NAME, CODE_RANGE)
+    row = vals[0] if vals else []
+    code = str(row[0]) if row else ""
+    saved_at = str(row[1]) if len(row) > 1 else ""
+    return code, saved_at
 
 
 # ------------------ 관리자 비밀번호 설정 ------------------
@@ -293,6 +282,12 @@ if "admin_mode" not in st.session_state:
 if "admin_code" not in st.session_state:
     st.session_state.admin_code = ""
 
+# ------------------ 이번 재실행 기준 시각 (한 번만 계산해 아래에서 재사용) ------------------
+now = datetime.now(KST)
+now_str = now.strftime("%Y-%m-%d %H:%M:%S")
+date_key = now.strftime("%Y-%m-%d")   # 하루 1건 정책 토큰용
+day_str = now.strftime("%Y%m%d")      # 다운로드 파일명용
+
 
 # 관리자 모드
 st.sidebar.subheader("관리자 전용")
@@ -332,11 +327,12 @@ if st.session_state.admin_mode:
 
         if save_code and code_input.strip() != "":
             st.session_state.admin_code = code_input
-            with sheet_lock:
-                code_sheet.clear()
-            ok = safe_append_row(code_sheet, [str(code_input), datetime.now(KST).strftime("%Y-%m-%d %H:%M:%S")])
+            digest = code_digest(code_input)
+            ok = save_code_cell(code_sheet, digest, now_str)
             if ok:
-                st.cache_data.clear()
+                state = code_state()
+                state["value"], state["ts"] = digest, time.time()
+                fetch_range.clear(SPREADSHEET_NAME, CODE_RANGE)
                 st.success("출석 코드가 저장되었습니다.")
             else:
                 st.error("코드 저장에 실패했습니다. 잠시 후 다시 시도해 주세요.")
@@ -368,7 +364,6 @@ with st.form("attendance_form", clear_on_submit=False):
         )
         if "attendance_input" not in st.session_state:
             st.session_state.attendance_input = ""
-        latest_code = get_latest_code()
         st.session_state.attendance_input = st.text_input(
             "오늘의 출석 코드",
             value=st.session_state.attendance_input,
@@ -391,108 +386,257 @@ with st.form("attendance_form", clear_on_submit=False):
 
     submitted = st.form_submit_button("제출")
 
+# 지난 제출들의 백그라운드 기록 결과 확인 (실패 시 알림)
+settle_pending_attendance()
+
 # ✅ 기존 제출 로직을 submitted가 True일 때만 실행
 if submitted:
-    now_str = datetime.now(KST).strftime("%Y-%m-%d %H:%M:%S")
-
-    # 이름/개인번호 확인
-    if not ((df["이름"] == name) & (df["고유번호"].astype(str) == personal_code)).any():
+    # 이름/개인번호 확인 (앞뒤 공백은 명단과 똑같이 제거 → 기록되는 이름도 정규화됨)
+    name, personal_code = name.strip(), personal_code.strip()
+    if (name, personal_code) not in MEMBERS["pairs"]:
         st.error("이름 또는 개인 고유번호가 올바르지 않습니다.")
     else:
         if status == "출석":
             if partner.strip() == "":
                 st.error("오늘 같이 활동한 사람을 입력하세요.")
             else:
-                input_code = str(st.session_state.attendance_input).strip()
-                saved_code = str(get_latest_code()).strip()
+                input_hash = code_digest(st.session_state.attendance_input)
+                saved_hash = str(get_latest_code()).strip()
 
-                if input_code != saved_code:
+                # 바이트로 비교 → 시트에 남은 옛 평문 코드(한글 등 비ASCII)여도 TypeError 없이 불일치 처리
+                if not hmac.compare_digest(input_hash.encode("utf-8"), saved_hash.encode("utf-8")):
                     st.error("출석 코드가 올바르지 않습니다.")
                     st.warning("⚠️ 거짓이나 꾸며서 입력했을 시 바로 퇴출됩니다.")
                 else:
-                    # ✅ 코드가 맞으면 출석 기록 처리 (append_once 사용)
-                    date_key = datetime.now(KST).strftime("%Y-%m-%d")   # 하루 1건 정책
+                    # ✅ 코드가 맞으면 출석 기록 처리 (배치 writer → append_once)
                     token = daily_token(name, date_key)
                     values = [name, now_str, "출석", time_slot, partner, "", token]
 
-                    ok = append_once(sheet, values)
+                    ok = submit_attendance(values)
                     if ok:
                         st.success(f"{name}님 출석 완료 ✅")
-                        st.session_state.local_attendance = st.session_state.get("local_attendance", [])
-                        st.session_state.local_attendance.append(values)
-                        st.session_state.attendance_input = ""
-                        st.warning("⚠️ 거짓이나 꾸며서 입력했을 시 바로 퇴출됩니다.")
+                    elif ok is None:
+                        st.info(f"{name}님 출석 접수됨 ⏳ (기록 중, 잠시 후 반영됩니다)")
                     else:
-                        st.error("일시적 오류로 저장에 실패했습니다. 잠시 후 다시 시도해 주세요.")
+                        st.error("출석 기록 저장에 실패했습니다. 다시 제출해 주세요.")
+                    if ok is not False:
+                        st.session_state.attendance_input = ""
+                    st.warning("⚠️ 거짓이나 꾸며서 입력했을 시 바로 퇴출됩니다.")
 
         elif status == "결석":
             if st.session_state.absence_reason.strip() == "":
                 st.error("결석 사유를 입력하세요.")
             else:
-                date_key = datetime.now(KST).strftime("%Y-%m-%d")
                 token = daily_token(name, date_key)
                 values = [name, now_str, "결석", "", "", st.session_state.absence_reason, token]
 
-                ok = append_once(sheet, values)
+                ok = submit_attendance(values)
                 if ok:
                     st.success(f"{name}님 결석 처리 완료 ✅")
-                    st.session_state.local_attendance = st.session_state.get("local_attendance", [])
-                    st.session_state.local_attendance.append(values)
+                elif ok is None:
+                    st.info(f"{name}님 결석 접수됨 ⏳ (기록 중, 잠시 후 반영됩니다)")
                 else:
-                    st.error("일시적 오류로 저장에 실패했습니다. 잠시 후 다시 시도해 주세요.")
+                    st.error("결석 기록 저장에 실패했습니다. 다시 제출해 주세요.")
 
 
 
 # ================== 출석 현황 대시보드 (관리자 전용) ==================
 # ================== 출석 현황 대시보드 (관리자 전용) ==================
-@st.cache_data(ttl=300)  # 5분 캐싱
-def get_attendance_df():
-    """출석기록 시트를 DataFrame으로 불러오기 (헤더 자동 인식)"""
+# 표준 컬럼명 ← 시트 헤더에 들어 있을 수 있는 키워드 (각 표준 이름당 처음 일치하는 컬럼 하나만)
+ATT_COLUMN_RULES = (
+    ("이름", ("이름", "성명")),
+    ("시간", ("시간", "날짜", "등록")),
+    ("출석여부", ("출석", "상태")),
+)
+
+def _canonical_att_columns(columns) -> dict[str, str]:
+    """출석기록 헤더 → 표준 이름 rename 매핑. ('시간대'처럼 뒤에 또 걸리는 컬럼은 그대로 둠)"""
+    mapping: dict[str, str] = {}
+    for canon, keys in ATT_COLUMN_RULES:
+        col = next((c for c in columns if c not in mapping and any(k in c for k in keys)), None)
+        if col is not None:
+            mapping[col] = canon
+    return mapping
+
+# 출석기록 TTL: 최근 ATT_ACTIVE_WINDOW초 안에 제출이 있으면 짧게(신선도), 한산하면 길게(API 쿼터)
+ATT_TTL_ACTIVE = 30
+ATT_TTL_IDLE = 1800
+ATT_ACTIVE_WINDOW = 300
+
+@st.cache_resource
+def attendance_cache() -> dict:
+    """
+    프로세스 전역 출석기록 캐시 상태. 모든 세션이 같은 DataFrame을 공유.
+    - header/rows: 시트 헤더와 '오늘' 원본 행들, last_row: 지금까지 읽은 마지막 시트 행 번호
+    """
+    return {"value": None, "expires": 0.0, "last_submit": 0.0,
+            "header": None, "rows": [], "last_row": 0, "full_at": 0.0, "day": None, "failed": False,
+            "gen": 0, "written_row": None}
+
+@st.cache_resource
+def attendance_refresh_lock() -> threading.Lock:
+    """출석기록 새로고침은 한 번에 한 스레드만 (나머지는 기다렸다가 갱신된 값을 그대로 사용)."""
+    return threading.Lock()
+
+def invalidate_attendance_df(written_row: int | None = None) -> None:
+    """
+    다음 get_attendance_df(today) 호출에서 다시 불러오도록 만료시킴 (쓰기 스레드에서도 호출).
+    written_row: 방금 기록된 마지막 시트 행 번호(append_rows 응답) → 꼬리 조회 일관성 확인용
+    """
+    state = attendance_cache()
+    state["written_row"] = written_row
+    state["gen"] += 1  # 진행 중인 새로고침이 이 무효화를 덮어쓰지 않도록 세대 번호도 올림
+    state["expires"] = 0.0
+
+def get_attendance_df(today):
+    """
+    today(재실행마다 한 번 구한 KST 날짜)의 출석기록을 DataFrame으로 불러오기 (헤더 자동 인식)
+    - 모든 세션이 같은 객체를 공유하므로 호출 측은 읽기만 하거나 .copy() 후 수정
+    - TTL은 최근 제출 여부에 따라 30초 / 30분 (만료 시각은 불러올 때 정함)
+    - 전체 시트는 30분에 한 번만 읽고, 그 사이에는 마지막으로 읽은 행 다음(꼬리)만 조회
+    - 꼬리까지 읽은 행 수가 마지막 기록의 끝 행과 어긋나거나 직전 조회가 실패했으면 전체를 다시 읽음
+    """
+    state = attendance_cache()
+    if state["value"] is not None and time.time() < state["expires"] and state["day"] == today:
+        return state["value"]
+
+    with attendance_refresh_lock():
+        # 기다리는 동안 다른 스레드가 이미 새로 불러왔으면 그 값을 사용
+        now_ts = time.time()
+        if state["value"] is not None and now_ts < state["expires"] and state["day"] == today:
+            return state["value"]
+        return _refresh_attendance_df(state, today, now_ts)
+
+def _refresh_attendance_df(state: dict, today, now_ts: float) -> pd.DataFrame:
+    """
+    attendance_refresh_lock 안에서만 호출. 시트 조회·가공은 지역 변수로 하고
+    header/rows/last_row/value/expires 등은 끝에서 한꺼번에 반영 (중간 상태가 남지 않게).
+    """
+    gen = state["gen"]
+    active = now_ts - state["last_submit"] < ATT_ACTIVE_WINDOW
+    ttl = ATT_TTL_ACTIVE if active else ATT_TTL_IDLE
+    full_at = state["full_at"]
     try:
-        df_att = pd.DataFrame(sheet.get_all_records())  # 시트 헤더 첫 행
-        if df_att.empty:
-            return pd.DataFrame(columns=["이름", "시간", "상태", "사유"])
-        return df_att
+        full = state["header"] is None or now_ts - full_at > ATT_TTL_IDLE
+        if not full:
+            # 증분: 오늘 행은 시트 끝에 쌓이므로 새로 붙은 꼬리만 values.get 한 번
+            header = state["header"]
+            tail = sheet.get(f"A{state['last_row'] + 1}:{TOKEN_COL_A1}")
+            rows, last_row = state["rows"] + tail, state["last_row"] + len(tail)
+            # 일관성 확인(추가 호출 없음): 마지막 기록의 끝 행과 다르면
+            # 중간 행 삭제·수동 입력 등 꼬리로는 못 따라가는 변화 → 전체 다시
+            written = state["written_row"]
+            full = written is not None and written != last_row
+        if full:
+            # 전체 로드: 출석기록 범위만 읽음 (수동 편집도 여기서 반영)
+            vals = fetch_range(SPREADSHEET_NAME, ATT_RANGE)
+            header, rows = (vals[0], vals[1:]) if vals else (None, [])
+            last_row, full_at = len(vals), now_ts
     except Exception as e:
-        st.error(f"출석기록 불러오기 실패: {e}")
-        return pd.DataFrame(columns=["이름", "시간", "상태", "사유"])
+        if not state["failed"]:  # 연속 실패 동안에는 한 번만 알림
+            st.error(f"출석기록 불러오기 실패: {e}")
+        state["failed"] = True
+        state["full_at"] = 0.0  # 어디까지 읽었는지 확신할 수 없으므로 다음엔 전체 다시 읽기
+        state["expires"] = now_ts + ATT_TTL_ACTIVE  # 실패 시 이전 값(없으면 빈 표)을 짧게만 보관
+        if state["value"] is None:
+            state["value"] = _build_attendance_df([])
+        return state["value"]
+
+    df_att = _build_attendance_df([header] + rows if header else [])
+    # 대시보드는 오늘 행만 사용 → 오늘 것만 남겨 두면 프레임·해시·다음 증분 모두 O(오늘)
+    if "_date" in df_att.columns:
+        today_mask = (df_att["_date"] == pd.Timestamp(today)).to_numpy()
+        rows = [rows[i] for i in today_mask.nonzero()[0]]
+        df_att = df_att.loc[today_mask].reset_index(drop=True)
+    df_att.attrs["version"] = time.time_ns()  # 새로 불러올 때마다 바뀌는 버전 (대시보드 재계산 판단용)
+
+    # 조회 중에 기록이 끝났으면(gen 변경) 방금 읽은 값에 빠졌을 수 있으므로 바로 만료
+    # 같은 세대면 마지막 기록 행까지 확인을 마쳤으므로 비움 (어긋난 값으로 전체 로드가 반복되지 않게)
+    fresh = state["gen"] == gen
+    expires = now_ts + ttl if fresh else 0.0
+    if fresh:
+        state["written_row"] = None
+    state.update(header=header, rows=rows, last_row=last_row, full_at=full_at,
+                 value=df_att, expires=expires, day=today, failed=False)
+    return df_att
+
+def _build_attendance_df(vals: list[list[str]]) -> pd.DataFrame:
+    """시트 값(2차원 리스트) → 표준 컬럼/타입을 맞춘 출석기록 DataFrame."""
+    if vals:
+        df_att = rows_to_frame(vals[1:], vals[0])  # 시트 헤더 첫 행
+    else:
+        df_att = pd.DataFrame()
+    if df_att.empty:
+        df_att = pd.DataFrame(columns=["이름", "시간", "상태", "사유"])
 
+    # 헤더를 로드 시 한 번만 표준 이름(이름/시간/출석여부)으로 맞춤 → 이후 코드는 고정 이름 사용
+    df_att = df_att.rename(columns=_canonical_att_columns(df_att.columns))
+    # 시간 컬럼은 로드 시 한 번만 datetime으로 변환 (이후 날짜 비교는 int64 벡터 연산)
+    if "시간" in df_att.columns:
+        df_att["시간"] = pd.to_datetime(df_att["시간"].astype(str), format="%Y-%m-%d %H:%M:%S", errors="coerce")
+        df_att["_date"] = df_att["시간"].dt.normalize()  # 자정 기준 날짜(datetime64) → 오늘 필터는 등호 한 번
+    return categorize(df_att, ("이름", "출석여부", "사유"))
 
-def split_today_status(df_att, all_members):
-    import datetime
-    today_str = datetime.datetime.now().strftime("%Y-%m-%d")
 
-    # 컬럼 탐색
-    col_time = next((c for c in df_att.columns if "시간" in c or "날짜" in c or "등록" in c), None)
-    col_status = next((c for c in df_att.columns if "출석" in c or "상태" in c), None)
-    col_name = next((c for c in df_att.columns if "이름" in c or "성명" in c), None)
+def _frame_digest(df_: pd.DataFrame):
+    # 캐시 키용 해시: 직렬화 대신 pandas 벡터 해시 한 번 (내용이 바뀌면 키도 바뀜)
+    return df_.shape, tuple(df_.columns), int(pd.util.hash_pandas_object(df_, index=False).sum())
 
-    if not col_time or not col_status or not col_name:
+@st.cache_data(ttl=60, hash_funcs={pd.DataFrame: _frame_digest})
+def split_today_status(df_att, member_names: tuple[str, ...], today):
+    """
+    오늘(today) 기록을 출석/결석/미체크로 분류.
+    (출석기록 내용, 명단, 날짜)가 같으면 재실행마다 다시 계산하지 않고 캐시 재사용.
+    """
+    if not {"이름", "시간", "출석여부"}.issubset(df_att.columns):
         st.error("출석 기록에서 필수 컬럼을 찾을 수 없습니다.")
-        return pd.DataFrame(), pd.DataFrame(), pd.DataFrame(), len(all_members)
-
-    # 오늘 날짜 필터링
-    today_att = df_att[df_att[col_time].astype(str).str.startswith(today_str, na=False)].copy()
+        return pd.DataFrame(), pd.DataFrame(), pd.DataFrame(), len(member_names)
+
+    # 오늘 날짜 필터링 (로드 시 만들어 둔 _date와 int64 등호 비교 한 번)
+    today_mask = df_att["_date"] == pd.Timestamp(today)
+    today_att = df_att.loc[today_mask]
+
+    # 출석 우선: 출석 행을 앞으로(안정 정렬) 보낸 뒤 이름당 첫 행만 남기면
+    # 한 사람은 출석/결석 중 하나로만 분류됨 → groupby 한 번으로 나눔
+    marked = today_att[today_att["출석여부"].isin(("출석", "결석"))]
+    first = (
+        marked.sort_values("출석여부", key=lambda s: s != "출석", kind="stable")
+        .drop_duplicates(subset=["이름"])
+    )
+    groups = dict(tuple(first.groupby("출석여부", observed=True, sort=False)))
+    empty = today_att.iloc[:0]
+    df_attended = groups.get("출석", empty)
+    df_absented = groups.get("결석", empty)
 
-    # 출석/결석 분류
-    df_attended = today_att[today_att[col_status] == "출석"].copy()
-    df_absented = today_att[today_att[col_status] == "결석"].copy()
+    # 미체크자 계산 (명단 순서 유지, 포함 여부는 pandas 해시 테이블로 O(명단+제출))
+    submitted = today_att["이름"].astype(str).str.strip().unique()
+    all_names = pd.Index(member_names)
+    unchecked_names = all_names[~all_names.isin(submitted)]
 
-    # 중복 이름 제거
-    df_attended = df_attended.drop_duplicates(subset=[col_name])
-    df_absented = df_absented.drop_duplicates(subset=[col_name])
+    df_unchecked = pd.DataFrame({"이름": unchecked_names.to_numpy()})
 
-    # 출석 우선
-    df_absented = df_absented[~df_absented[col_name].isin(df_attended[col_name])]
+    return df_attended, df_absented, df_unchecked, len(member_names)
 
-    # 미체크자 계산
-    submitted_names = [str(name).strip() for name in today_att[col_name].tolist()]
-    all_member_names = [str(name).strip() for name in all_members["이름"].tolist()]
-    unchecked_names = [name for name in all_member_names if name not in submitted_names]
 
-    df_unchecked = pd.DataFrame(unchecked_names, columns=["이름"])
+def merge_local_attendance(df_att: pd.DataFrame) -> pd.DataFrame:
+    """
+    이 세션에서 방금 기록한 행(local_attendance)을 대시보드에 바로 반영.
+    - 시트에 이미 올라온 토큰은 세션 목록에서 정리, 아직 안 보이는 행만 덧붙임
+    """
+    rows = st.session_state.get("local_attendance", [])
+    if not rows or "토큰" not in df_att.columns or len(df_att.columns) < len(rows[0]):
+        return df_att
+    seen = set(df_att["토큰"].astype(str))
+    rows = [r for r in rows if str(r[-1]) not in seen]
+    st.session_state.local_attendance = rows
+    if not rows:
+        return df_att
 
-    return df_attended, df_absented, df_unchecked, len(all_members)
+    local = pd.DataFrame(rows, columns=df_att.columns[:len(rows[0])])
+    if "시간" in local.columns:
+        local["시간"] = pd.to_datetime(local["시간"], format="%Y-%m-%d %H:%M:%S", errors="coerce")
+        local["_date"] = local["시간"].dt.normalize()
+    return pd.concat([df_att, local], ignore_index=True)
 
 
 # ====== 출석 현황: 모두에게 표시, 다운로드는 관리자만 ======
@@ -501,11 +645,17 @@ def split_today_status(df_att, all_members):
 st.markdown("---")
 st.subheader("📊 오늘의 출석 현황")
 
-# 데이터 불러오기
-att_df = get_attendance_df()
+# 데이터 불러오기 (캐시된 시트 + 이 세션에서 방금 기록한 행)
+base_att_df = get_attendance_df(now.date())
+att_df = merge_local_attendance(base_att_df)
 
-# 오늘 기준 분류
-df_attended, df_absented, df_unchecked, total_members = split_today_status(att_df, df)
+# 오늘 기준 분류: (시트 버전, 행 수, 날짜)가 지난 재실행과 같으면 세션에 둔 결과 재사용
+# (입력창 타이핑 등으로 인한 재실행에서는 프레임 해시/캐시 역직렬화도 건너뜀)
+dashboard_version = (base_att_df.attrs.get("version"), len(att_df), now.date())
+if st.session_state.get("dashboard_version") != dashboard_version or "dashboard_cache" not in st.session_state:
+    st.session_state.dashboard_cache = split_today_status(att_df, MEMBERS["names"], now.date())
+    st.session_state.dashboard_version = dashboard_version
+df_attended, df_absented, df_unchecked, total_members = st.session_state.dashboard_cache
 
 # 지표 (관리자/비관리자 모두 표시)
 col1, col2, col3, col4 = st.columns(4)
@@ -514,14 +664,11 @@ col2.metric("출석", len(df_attended))
 col3.metric("결석", len(df_absented))
 col4.metric("미체크", len(df_unchecked))
 
-# === 컬럼 안전 매핑 & 선택 유틸 ===
-def map_columns_safe(df_):
-    if df_.empty:
-        return None, None, None
-    col_name = next((c for c in df_.columns if "이름" in c or "성명" in c), None)
-    col_time = next((c for c in df_.columns if "시간" in c or "날짜" in c or "등록" in c), None)
-    col_status = next((c for c in df_.columns if "출석" in c or "상태" in c), None)
-    return col_name, col_time, col_status
+# === 선택 유틸 (컬럼명은 get_attendance_df에서 표준화됨) ===
+@st.cache_data(hash_funcs={pd.DataFrame: _frame_digest})
+def df_to_csv_bytes(df_: pd.DataFrame) -> bytes:
+    """다운로드용 CSV 바이트(엑셀 호환 BOM 포함). 데이터가 같으면 재실행 시 캐시 재사용."""
+    return df_.to_csv(index=False).encode("utf-8-sig")
 
 def safe_select(df_, cols):
     existing = [c for c in cols if c and c in df_.columns]
@@ -529,7 +676,7 @@ def safe_select(df_, cols):
         return pd.DataFrame(columns=[c for c in cols if c])
     return df_[existing]
 
-name_col, time_col, status_col = map_columns_safe(df_attended)
+name_col, time_col, status_col = "이름", "시간", "출석여부"
 
 # 출석자
 # === 출석자 ===
@@ -537,9 +684,11 @@ name_col, time_col, status_col = map_columns_safe(df_attended)
 with st.expander("✅ 출석자 명단 보기", expanded=False):
     attended_display = safe_select(df_attended, [name_col, time_col, status_col]).copy()
     if not attended_display.empty:
-        attended_display["_g"] = attended_display[name_col].map(lambda n: _gcn_tuple_for(n)[0])
-        attended_display["_c"] = attended_display[name_col].map(lambda n: _gcn_tuple_for(n)[1])
-        attended_display["_n"] = attended_display[name_col].map(lambda n: _gcn_tuple_for(n)[2])
+        # (학년,반,번호) 정렬 키를 이름 인덱스로 한 번에 조회 (없는 이름은 999 → 후순위)
+        # merge 대신 reindex → 행 인덱스가 그대로 유지됨
+        names = attended_display[name_col].astype(str).str.strip().to_numpy()
+        sort_keys = MEMBERS["gcn_df"].reindex(names).fillna(999).astype(int)
+        attended_display[["_g", "_c", "_n"]] = sort_keys.to_numpy()
         attended_display = (
             attended_display
             .sort_values(by=["_g", "_c", "_n", name_col], kind="stable")
@@ -547,17 +696,16 @@ with st.expander("✅ 출석자 명단 보기", expanded=False):
         )
 
         if st.session_state.admin_mode:
-            selected_attendees = []
-            for idx, row in attended_display.iterrows():
-                col1, col2, col3 = st.columns([2, 3, 2])
-                with col1:
-                    checked = st.checkbox(row[name_col], key=f"attendee_{idx}")
-                with col2:
-                    st.write(row[time_col])
-                with col3:
-                    st.write(row[status_col])
-                if checked:
-                    selected_attendees.append(row[name_col])
+            # 행마다 체크박스+컬럼 3개를 만드는 대신 편집 표 위젯 하나로 선택
+            edited = st.data_editor(
+                attended_display.assign(선택=False),
+                key="attendees_editor",
+                column_config={"선택": st.column_config.CheckboxColumn("선택")},
+                disabled=[name_col, time_col, status_col],
+                hide_index=True,
+                width="stretch",
+            )
+            selected_attendees = edited.loc[edited["선택"], name_col].astype(str).tolist()
             st.info(f"선택된 출석자: {', '.join(selected_attendees) if selected_attendees else '없음'}")
         else:
             st.table(attended_display)
@@ -579,20 +727,20 @@ if st.session_state.admin_mode:
     colD1, colD2, colD3 = st.columns(3)
     colD1.download_button(
         "출석자 CSV 다운로드",
-        data=attended_display.to_csv(index=False, encoding="utf-8-sig") if not attended_display.empty else "",
-        file_name=f"출석자_{datetime.now().strftime('%Y%m%d')}.csv",
+        data=df_to_csv_bytes(attended_display) if not attended_display.empty else "",
+        file_name=f"출석자_{day_str}.csv",
         mime="text/csv",
     )
     colD2.download_button(
         "결석자 CSV 다운로드",
-        data=absented_display.to_csv(index=False, encoding="utf-8-sig") if not absented_display.empty else "",
-        file_name=f"결석자_{datetime.now().strftime('%Y%m%d')}.csv",
+        data=df_to_csv_bytes(absented_display) if not absented_display.empty else "",
+        file_name=f"결석자_{day_str}.csv",
         mime="text/csv",
     )
     colD3.download_button(
         "미체크자 CSV 다운로드",
-        data=unchecked_display.to_csv(index=False, encoding="utf-8-sig") if not unchecked_display.empty else "",
-        file_name=f"미체크자_{datetime.now().strftime('%Y%m%d')}.csv",
+        data=df_to_csv_bytes(unchecked_display) if not unchecked_display.empty else "",
+        file_name=f"미체크자_{day_str}.csv",
         mime="text/csv",
     )
 